@@ -1,8 +1,13 @@
 import os
 import re
+import mmap
+import hashlib
 import logging
-from typing import List, Dict, Any
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Dict, Any, Optional
 import pdfplumber
+import pymupdf
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
 
@@ -16,20 +21,46 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def extract_article_with_context(text: str) -> List[Dict[str, str]]:
+# Hilos para la extracción con pdfplumber dentro de un mismo PDF
+PDFPLUMBER_THREADS = 4
+
+# Patrones precompilados (se usan por página y por documento)
+# Patrón mejorado para detectar artículos
+_ART_RE = re.compile(r'(?:Artículo|Art\.) *(\d+)[.\s]+(.*?)(?=(?:Artículo|Art\.) *\d+[.\s]|$)', re.DOTALL)
+_SPACE_RE = re.compile(r'[ \t]+|\n{3,}')
+_BAD_RE = re.compile(r'[^\w\s\.,;:()¿?¡!-]')
+
+class _CleanTable(dict):
+    """
+    str.translate table that drops disallowed characters, filled lazily
+    """
+    def __missing__(self, codepoint: int) -> Optional[int]:
+        value = None if _BAD_RE.match(chr(codepoint)) else codepoint
+        self[codepoint] = value
+        return value
+
+# Preservar estructura: los saltos de página pasan a ser párrafos
+_CLEAN_TABLE = _CleanTable({ord('\f'): '\n\n'})
+
+def _normalize_space(match: re.Match) -> str:
+    """
+    Collapse a run of spaces/tabs to one space and 3+ newlines to two
+    """
+    return '\n\n' if match.group()[0] == '\n' else ' '
+
+def extract_article_with_context(text: str) -> List[Dict[str, Any]]:
     """
     Extract articles while preserving their complete content and context
     """
-    # Patrón mejorado para detectar artículos
-    article_pattern = r'(?:Artículo|Art\.) *(\d+)[.\s]+(.*?)(?=(?:Artículo|Art\.) *\d+[.\s]|$)'
     articles = []
     
-    for match in re.finditer(article_pattern, text, re.DOTALL):
+    for match in _ART_RE.finditer(text):
         article_num = match.group(1)
         content = match.group(2).strip()
         articles.append({
             'number': article_num,
-            'content': f"Artículo {article_num}. {content}"
+            'content': f"Artículo {article_num}. {content}",
+            'start': match.start()
         })
     
     return articles
@@ -41,19 +72,24 @@ def clean_text(text: str) -> str:
     if not text:
         return ""
     
-    # Preservar estructura
-    text = text.replace('\f', '\n\n')
+    # Limpiar caracteres especiales pero mantener puntuación importante
+    text = text.translate(_CLEAN_TABLE)
     
     # Normalizar espacios pero mantener estructura
-    text = re.sub(r'[ \t]+', ' ', text)
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    # Limpiar caracteres especiales pero mantener puntuación importante
-    text = re.sub(r'[^\w\s\.,;:()¿?¡!-]', '', text)
+    text = _SPACE_RE.sub(_normalize_space, text)
     
     return text.strip()
 
-def log_extraction_details(filename: str, text: str, articles: List[Dict[str, str]]):
+def page_for_offset(offset: int, page_starts: List[int], page_numbers: List[int]) -> Optional[int]:
+    """
+    Return the page number containing a character offset of the cleaned text
+    """
+    pos = bisect_right(page_starts, offset) - 1
+    if pos < 0:
+        return None
+    return page_numbers[pos]
+
+def log_extraction_details(filename: str, text: str, articles: List[Dict[str, Any]]):
     """
     Log extraction details for verification
     """
@@ -68,106 +104,192 @@ def log_extraction_details(filename: str, text: str, articles: List[Dict[str, st
             logger.info(f"\nArticle {article['number']} content:")
             logger.info(f"{article['content'][:200]}...")  # Primeros 200 caracteres
 
-def extract_text_from_folder(folder_path: str) -> List[Document]:
+def file_sha256(file_path: str) -> str:
     """
-    Process all PDFs with enhanced article preservation
+    SHA-256 of a file's contents, read through a memory map
     """
-    all_documents = []
-    pdf_files = [f for f in os.listdir(folder_path) if f.lower().endswith('.pdf')]
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+    return digest.hexdigest()
+
+def extract_pages_with_pdfplumber(file_path: str, page_numbers: List[int]) -> Dict[int, str]:
+    """
+    Extract the given 1-based pages with pdfplumber.
+    Opens its own handle, since pdfplumber documents are not thread-safe.
+    """
+    page_texts = {}
+    with pdfplumber.open(file_path, pages=page_numbers) as pdf:
+        for page in pdf.pages:
+            page_text = page.extract_text()
+            if page_text:
+                page_texts[page.page_number] = page_text
+    return page_texts
+
+def extract_page_texts(file_path: str) -> Dict[int, str]:
+    """
+    Extract the text of each page, keyed by 1-based page number
+    """
+    page_texts = {}
+    
+    # PyMuPDF is much faster than pdfplumber for plain text
+    with pymupdf.open(file_path) as doc:
+        n_pages = len(doc)
+        for i, page in enumerate(doc, 1):
+            page_text = page.get_text("text")
+            if page_text.strip():
+                page_texts[i] = page_text
+    
+    if page_texts or not n_pages:
+        return page_texts
     
-    for filename in pdf_files:
-        file_path = os.path.join(folder_path, filename)
-        logger.info(f"\nProcessing: {filename}")
+    # Fall back to pdfplumber when PyMuPDF finds no text, splitting the
+    # pages into contiguous ranges extracted by separate threads
+    logger.info(f"No text found with PyMuPDF in {file_path}, trying pdfplumber")
+    n_workers = min(PDFPLUMBER_THREADS, n_pages)
+    step = -(-n_pages // n_workers)
+    page_ranges = [
+        list(range(first, min(first + step, n_pages + 1)))
+        for first in range(1, n_pages + 1, step)
+    ]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        results = executor.map(
+            lambda pages: extract_pages_with_pdfplumber(file_path, pages), page_ranges
+        )
+        for texts in results:
+            page_texts.update(texts)
+    
+    return page_texts
+
+def process_pdf(file_path: str) -> List[Document]:
+    """
+    Extract article and general documents from a single PDF
+    """
+    documents = []
+    filename = os.path.basename(file_path)
+    logger.info(f"\nProcessing: {filename}")
+    
+    try:
+        page_texts = extract_page_texts(file_path)
+        
+        # Clean each page once, recording where it starts in the full text
+        segments = []
+        page_starts = []
+        page_numbers = []
+        offset = 0
+        for i, page_text in page_texts.items():
+            segment = f"PÁGINA {i}\n{clean_text(page_text)}"
+            page_starts.append(offset)
+            page_numbers.append(i)
+            segments.append(segment)
+            offset += len(segment) + 2
+        cleaned_text = "\n\n".join(segments)
+        
+        # Extract articles
+        articles = extract_article_with_context(cleaned_text)
+        
+        # Log extraction details
+        log_extraction_details(filename, cleaned_text, articles)
+        
+        # Create base metadata
+        base_metadata = {
+            "source": filename,
+            "file_path": file_path,
+            "file_hash": file_sha256(file_path)
+        }
         
-        try:
-            with pdfplumber.open(file_path) as pdf:
-                full_text = ""
-                page_texts = {}
-                
-                # Extract text with page numbers
-                for i, page in enumerate(pdf.pages, 1):
-                    page_text = page.extract_text()
-                    if page_text:
-                        page_texts[i] = page_text
-                        full_text += f"\n[PÁGINA {i}]\n{page_text}"
-                
-                # Clean the text
-                cleaned_text = clean_text(full_text)
-                
-                # Extract articles
-                articles = extract_article_with_context(cleaned_text)
-                
-                # Log extraction details
-                log_extraction_details(filename, cleaned_text, articles)
-                
-                # Create base metadata
-                base_metadata = {
-                    "source": filename,
-                    "file_path": file_path
-                }
-                
-                # Process articles first (priority content)
-                for article in articles:
-                    # Find the page number for this article
-                    page_num = None
-                    article_content = article['content']
-                    for page_num, page_text in page_texts.items():
-                        if article_content in clean_text(page_text):
-                            break
-                    
-                    metadata = base_metadata.copy()
-                    metadata.update({
-                        'content_type': 'article',
-                        'article_number': article['number'],
-                        'page': page_num
-                    })
-                    
-                    # Create document for the complete article
-                    all_documents.append(Document(
-                        page_content=article['content'],
-                        metadata=metadata
-                    ))
-                
-                # Process remaining text (non-article content)
-                splitter = RecursiveCharacterTextSplitter(
-                    chunk_size=1500,  # Increased chunk size
-                    chunk_overlap=300,  # Increased overlap
-                    separators=["\n\n", "\n", ". "]
-                )
-                
-                # Remove article content from the text
-                for article in articles:
-                    cleaned_text = cleaned_text.replace(article['content'], '')
-                
-                # Split remaining text
-                chunks = splitter.split_text(cleaned_text)
-                
-                # Create documents for non-article content
-                for chunk in chunks:
-                    if len(chunk.strip()) < 100:  # Skip very small chunks
-                        continue
-                    
-                    # Find page number for this chunk
-                    page_num = None
-                    for pnum, ptext in page_texts.items():
-                        if chunk in clean_text(ptext):
-                            page_num = pnum
-                            break
-                    
-                    metadata = base_metadata.copy()
-                    metadata.update({
-                        'content_type': 'general',
-                        'page': page_num
-                    })
-                    
-                    all_documents.append(Document(
-                        page_content=chunk,
-                        metadata=metadata
-                    ))
-                
-        except Exception as e:
-            logger.error(f"Error processing {filename}: {str(e)}")
-            continue
+        # Process articles first (priority content)
+        for article in articles:
+            # Find the page number for this article
+            page_num = page_for_offset(article['start'], page_starts, page_numbers)
+            
+            metadata = base_metadata.copy()
+            metadata.update({
+                'content_type': 'article',
+                'article_number': article['number'],
+                'page': page_num
+            })
+            
+            # Create document for the complete article
+            documents.append(Document(
+                page_content=article['content'],
+                metadata=metadata
+            ))
+        
+        # Process remaining text (non-article content)
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=1500,  # Increased chunk size
+            chunk_overlap=300,  # Increased overlap
+            separators=["\n\n", "\n", ". "]
+        )
+        
+        # Remove article content from the text
+        remaining_text = cleaned_text
+        for article in articles:
+            remaining_text = remaining_text.replace(article['content'], '')
+        
+        # Split remaining text
+        chunks = splitter.split_text(remaining_text)
+        
+        # Chunks come out in text order, so locate them with a moving cursor
+        cursor = 0
+        
+        # Create documents for non-article content
+        for chunk in chunks:
+            if len(chunk.strip()) < 100:  # Skip very small chunks
+                continue
+            
+            # Find page number for this chunk
+            page_num = None
+            chunk_start = cleaned_text.find(chunk, cursor)
+            if chunk_start != -1:
+                cursor = chunk_start
+                page_num = page_for_offset(chunk_start, page_starts, page_numbers)
+            
+            metadata = base_metadata.copy()
+            metadata.update({
+                'content_type': 'general',
+                'page': page_num
+            })
+            
+            documents.append(Document(
+                page_content=chunk,
+                metadata=metadata
+            ))
+    
+    except Exception as e:
+        logger.error(f"Error processing {filename}: {str(e)}")
+    
+    return documents
+
+def list_pdf_files(folder_path: str) -> List[str]:
+    """
+    Return the paths of the PDFs in a folder
+    """
+    return [
+        os.path.join(folder_path, f)
+        for f in os.listdir(folder_path) if f.lower().endswith('.pdf')
+    ]
+
+def parser_pool(n_files: int) -> ProcessPoolExecutor:
+    """
+    Process pool sized for parsing n_files PDFs
+    """
+    # PDF parsing is CPU-bound, so parse files in separate processes
+    max_workers = max(1, min(os.cpu_count() or 1, 8, n_files))
+    return ProcessPoolExecutor(max_workers=max_workers)
+
+def extract_text_from_files(pdf_paths: List[str]) -> List[Document]:
+    """
+    Process the given PDFs in parallel with enhanced article preservation
+    """
+    all_documents = []
+    
+    with parser_pool(len(pdf_paths)) as executor:
+        for documents in executor.map(process_pdf, pdf_paths):
+            all_documents.extend(documents)
     
     logger.info(f"\nTotal documents created: {len(all_documents)}")
     return all_documents
@@ -1,8 +1,19 @@
+import os
+import asyncio
 import logging
-from typing import List, Optional
+import uuid
+from functools import lru_cache
+from typing import Any, Collection, Dict, List, Optional, Tuple
+import faiss
+import numpy as np
 from langchain_openai import OpenAIEmbeddings
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain.docstore.document import Document
+from extract_documents import (
+    extract_text_from_files, file_sha256, list_pdf_files, parser_pool, process_pdf
+)
 
 logging.basicConfig(
     level=logging.INFO,
@@ -14,6 +25,144 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Parámetros del grafo HNSW
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Tipo de índice: "hnsw" por defecto, "ivfpq" para despliegues con poca memoria
+INDEX_TYPE = os.getenv("BAKECHAT_INDEX_TYPE", "hnsw").lower()
+
+# Parámetros de IVF-PQ (64 subvectores de 8 bits por embedding)
+IVFPQ_MAX_LISTS = 256
+IVFPQ_CODE = "PQ64x8"
+IVFPQ_NPROBE = 16
+IVFPQ_MIN_VECTORS = 256  # el cuantizador de 8 bits necesita 256 centroides
+
+# Resultados de index_new_files
+INDEX_UPDATED = "updated"  # se añadieron o reemplazaron documentos
+INDEX_SKIPPED = "skipped"  # todos los PDFs ya estaban indexados
+INDEX_EMPTY = "empty"      # no se extrajo texto de los PDFs nuevos
+INDEX_FAILED = "failed"    # falló el cálculo de embeddings o la indexación
+
+@lru_cache(maxsize=1)
+def get_embeddings() -> OpenAIEmbeddings:
+    """
+    Build the embeddings client used for indexing and search, once per process.
+    The client packs up to chunk_size texts per request.
+    """
+    return OpenAIEmbeddings(chunk_size=1000, max_retries=6, request_timeout=60)
+
+def inner_product_relevance(score: float) -> float:
+    """
+    Use the inner product of unit vectors (cosine similarity) as relevance
+    """
+    return score
+
+def vectorstore_options() -> dict:
+    """
+    Keyword arguments shared by every FAISS vectorstore built or loaded here.
+    OpenAI embeddings are unit-norm, so queries need no normalization.
+    """
+    return {
+        "distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT,
+        "relevance_score_fn": inner_product_relevance
+    }
+
+def build_faiss_index(matrix: np.ndarray) -> faiss.Index:
+    """
+    Build the raw FAISS index selected by INDEX_TYPE
+    """
+    dim = matrix.shape[1]
+    faiss.normalize_L2(matrix)
+    
+    if INDEX_TYPE == "ivfpq":
+        if len(matrix) >= IVFPQ_MIN_VECTORS:
+            nlist = min(IVFPQ_MAX_LISTS, len(matrix) // 39)
+            index = faiss.index_factory(
+                dim, f"IVF{nlist},{IVFPQ_CODE}", faiss.METRIC_INNER_PRODUCT
+            )
+            index.train(matrix)
+            index.add(matrix)
+            logger.info(f"Built IVF{nlist},{IVFPQ_CODE} index")
+            return index
+        logger.warning(
+            f"Only {len(matrix)} vectors, not enough to train IVF-PQ; using HNSW"
+        )
+    
+    index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+    index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    index.add(matrix)
+    return index
+
+def build_vectorstore(
+    documents: List[Document], 
+    vectors: List[List[float]], 
+    embeddings: OpenAIEmbeddings
+) -> FAISS:
+    """
+    Build a FAISS vectorstore from precomputed embeddings
+    """
+    index = build_faiss_index(np.asarray(vectors, dtype=np.float32))
+    
+    ids = [str(uuid.uuid4()) for _ in documents]
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, documents))),
+        index_to_docstore_id=dict(enumerate(ids)),
+        **vectorstore_options()
+    )
+    configure_search(vectorstore)
+    return vectorstore
+
+def configure_search(index: FAISS) -> None:
+    """
+    Apply query-time search parameters to the underlying FAISS index
+    """
+    if isinstance(index.index, faiss.IndexHNSW):
+        index.index.hnsw.efSearch = HNSW_EF_SEARCH
+        return
+    
+    ivf = faiss.try_extract_index_ivf(index.index)
+    if ivf is not None:
+        ivf.nprobe = IVFPQ_NPROBE
+
+@lru_cache(maxsize=1)
+def get_gpu_resources() -> "faiss.StandardGpuResources":
+    """
+    GPU resources shared by every index moved to the device
+    """
+    return faiss.StandardGpuResources()
+
+def is_gpu_index(index: faiss.Index) -> bool:
+    """
+    Check whether a raw FAISS index lives on the GPU
+    """
+    return hasattr(faiss, "GpuIndex") and isinstance(index, faiss.GpuIndex)
+
+def move_to_gpu(index: FAISS) -> None:
+    """
+    Move the underlying IVF index to the first GPU when one is available
+    """
+    if not hasattr(faiss, "get_num_gpus") or faiss.get_num_gpus() == 0:
+        return
+    
+    # Solo los índices IVF tienen implementación en GPU (HNSW no)
+    if faiss.try_extract_index_ivf(index.index) is None:
+        logger.info("Index type has no GPU implementation, searching on CPU")
+        return
+    
+    try:
+        # IVF-PQ con 64 subcuantizadores de 8 bits necesita tablas en float16
+        options = faiss.GpuClonerOptions()
+        options.useFloat16 = True
+        index.index = faiss.index_cpu_to_gpu(get_gpu_resources(), 0, index.index, options)
+        logger.info("Index moved to GPU")
+    
+    except Exception as e:
+        logger.warning(f"Could not move index to GPU, searching on CPU: {e}")
+
 def create_index(documents: List[Document]) -> Optional[FAISS]:
     """
     Create FAISS index from documents
@@ -23,8 +172,11 @@ def create_index(documents: List[Document]) -> Optional[FAISS]:
         return None
     
     try:
-        embeddings = OpenAIEmbeddings()
-        index = FAISS.from_documents(documents, embeddings)
+        embeddings = get_embeddings()
+        texts = [doc.page_content for doc in documents]
+        vectors = embeddings.embed_documents(texts)
+        index = build_vectorstore(documents, vectors, embeddings)
+        move_to_gpu(index)
         logger.info(f"Index created with {len(documents)} documents")
         return index
     
@@ -32,28 +184,238 @@ def create_index(documents: List[Document]) -> Optional[FAISS]:
         logger.error(f"Index creation failed: {e}")
         return None
 
+async def _parse_and_embed(
+    pdf_paths: List[str], 
+    embeddings: OpenAIEmbeddings
+) -> Tuple[List[Document], List[List[float]]]:
+    """
+    Overlap PDF parsing with embedding requests.
+    
+    Stage A parses files in a process pool and queues each file's documents,
+    stage B embeds them while the next files are still being parsed, and
+    stage C collects documents and vectors.
+    """
+    loop = asyncio.get_running_loop()
+    parsed = asyncio.Queue()
+    embedded = asyncio.Queue()
+    
+    async def parse_stage():
+        with parser_pool(len(pdf_paths)) as executor:
+            futures = [
+                loop.run_in_executor(executor, process_pdf, path)
+                for path in pdf_paths
+            ]
+            for future in asyncio.as_completed(futures):
+                await parsed.put(await future)
+        await parsed.put(None)
+    
+    async def embed_stage():
+        while (documents := await parsed.get()) is not None:
+            if documents:
+                vectors = await embeddings.aembed_documents(
+                    [doc.page_content for doc in documents]
+                )
+                await embedded.put((documents, vectors))
+        await embedded.put(None)
+    
+    async def collect_stage():
+        all_documents = []
+        all_vectors = []
+        while (item := await embedded.get()) is not None:
+            all_documents.extend(item[0])
+            all_vectors.extend(item[1])
+        return all_documents, all_vectors
+    
+    _, _, result = await asyncio.gather(parse_stage(), embed_stage(), collect_stage())
+    return result
+
+def create_index_from_folder(folder_path: str) -> Optional[FAISS]:
+    """
+    Parse, embed and index every PDF in a folder as one pipeline
+    """
+    pdf_paths = list_pdf_files(folder_path)
+    if not pdf_paths:
+        logger.warning(f"No PDFs found in {folder_path}")
+        return None
+    
+    try:
+        embeddings = get_embeddings()
+        documents, vectors = asyncio.run(_parse_and_embed(pdf_paths, embeddings))
+        if not documents:
+            logger.warning("No documents provided for indexing")
+            return None
+        
+        index = build_vectorstore(documents, vectors, embeddings)
+        move_to_gpu(index)
+        logger.info(f"Index created with {len(documents)} documents from {len(pdf_paths)} PDFs")
+        return index
+    
+    except Exception as e:
+        logger.error(f"Index creation failed: {e}")
+        return None
+
+def cpu_index(index: FAISS) -> faiss.Index:
+    """
+    The underlying FAISS index, copied back to the CPU if it lives on the GPU
+    """
+    raw = index.index
+    return faiss.index_gpu_to_cpu(raw) if is_gpu_index(raw) else raw
+
+def supports_remove(index: FAISS) -> bool:
+    """
+    Whether the underlying index can drop vectors with remove_ids (IVF can,
+    HNSW cannot). Only IVF indexes are ever moved to the GPU.
+    """
+    raw = index.index
+    return is_gpu_index(raw) or faiss.try_extract_index_ivf(raw) is not None
+
+def copy_vectorstore(index: FAISS) -> FAISS:
+    """
+    Independent CPU copy of a vectorstore, so updates never touch an index
+    that other sessions may be searching
+    """
+    raw = index.index
+    raw = faiss.index_gpu_to_cpu(raw) if is_gpu_index(raw) else faiss.clone_index(raw)
+    
+    index_to_docstore_id = dict(index.index_to_docstore_id)
+    docstore = InMemoryDocstore({
+        doc_id: index.docstore.search(doc_id)
+        for doc_id in index_to_docstore_id.values()
+    })
+    vectorstore = FAISS(
+        embedding_function=index.embeddings,
+        index=raw,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        **vectorstore_options()
+    )
+    configure_search(vectorstore)
+    return vectorstore
+
+def kept_entries(
+    index: FAISS, 
+    removed_ids: Collection[str]
+) -> Tuple[List[Document], List[Any]]:
+    """
+    Documents and vectors of a flat-storage (HNSW) index, leaving out
+    removed_ids
+    """
+    raw = cpu_index(index)
+    
+    positions = [
+        pos for pos, doc_id in sorted(index.index_to_docstore_id.items())
+        if doc_id not in removed_ids
+    ]
+    documents = [index.docstore.search(index.index_to_docstore_id[pos]) for pos in positions]
+    
+    vectors = [raw.reconstruct(pos) for pos in positions]
+    return documents, vectors
+
 def update_index(
     existing_index: Optional[FAISS], 
-    new_documents: List[Document]
+    new_documents: List[Document], 
+    removed_ids: Collection[str] = ()
 ) -> Optional[FAISS]:
     """
-    Update existing index with new documents
+    Return a new index with the documents of existing_index, minus
+    removed_ids, plus new_documents. existing_index itself is left untouched.
     """
-    if not new_documents:
+    if not new_documents and not removed_ids:
         return existing_index
     
     if existing_index is None:
         return create_index(new_documents)
     
     try:
-        existing_index.add_documents(new_documents)
-        logger.info(f"Index updated with {len(new_documents)} new documents")
-        return existing_index
+        embeddings = existing_index.embeddings
+        texts = [doc.page_content for doc in new_documents]
+        vectors = embeddings.embed_documents(texts) if texts else []
+        
+        if removed_ids and not supports_remove(existing_index):
+            # HNSW no admite remove_ids: reconstruir sin los documentos retirados
+            documents, kept_vectors = kept_entries(existing_index, removed_ids)
+            index = build_vectorstore(
+                documents + new_documents, kept_vectors + vectors, embeddings
+            )
+        else:
+            index = copy_vectorstore(existing_index)
+            if removed_ids:
+                # Los índices IVF eliminan vectores sin recalcular el resto
+                index.delete(list(removed_ids))
+            index.add_embeddings(
+                list(zip(texts, vectors)),
+                metadatas=[doc.metadata for doc in new_documents]
+            )
+        
+        move_to_gpu(index)
+        logger.info(
+            f"Index updated with {len(new_documents)} new documents, "
+            f"{len(removed_ids)} removed"
+        )
+        return index
     
     except Exception as e:
         logger.error(f"Index update failed: {e}")
         return existing_index
 
+def build_manifest(index: FAISS) -> Dict[str, Dict[str, Any]]:
+    """
+    Map the path of every indexed PDF to its content hash and docstore ids
+    """
+    manifest = {}
+    for doc_id in index.index_to_docstore_id.values():
+        doc = index.docstore.search(doc_id)
+        if not isinstance(doc, Document) or 'file_hash' not in doc.metadata:
+            continue
+        entry = manifest.setdefault(
+            doc.metadata['file_path'], 
+            {'file_hash': doc.metadata['file_hash'], 'ids': []}
+        )
+        entry['ids'].append(doc_id)
+    return manifest
+
+def index_new_files(
+    existing_index: Optional[FAISS], 
+    pdf_paths: List[str]
+) -> Tuple[Optional[FAISS], str]:
+    """
+    Parse and embed only the PDFs whose contents are not indexed yet. A file
+    whose contents changed under an indexed path replaces its old documents.
+    Returns the index and one of INDEX_UPDATED, INDEX_SKIPPED, INDEX_EMPTY
+    or INDEX_FAILED; on anything but INDEX_UPDATED the index is unchanged.
+    """
+    manifest = build_manifest(existing_index) if existing_index else {}
+    indexed_hashes = {entry['file_hash'] for entry in manifest.values()}
+    
+    new_paths = []
+    removed_ids = set()
+    for path in pdf_paths:
+        file_hash = file_sha256(path)
+        entry = manifest.get(path)
+        if entry and entry['file_hash'] != file_hash:
+            # Fichero sobrescrito: retirar la versión anterior del índice
+            removed_ids.update(entry['ids'])
+        elif file_hash in indexed_hashes:
+            continue
+        new_paths.append(path)
+    
+    skipped = len(pdf_paths) - len(new_paths)
+    if skipped:
+        logger.info(f"Skipping {skipped} PDFs already in the index")
+    if not new_paths:
+        return existing_index, INDEX_SKIPPED
+    
+    new_documents = extract_text_from_files(new_paths)
+    if not new_documents:
+        # Conservar la versión anterior si la nueva no tiene texto legible
+        logger.warning(f"No documents extracted from {len(new_paths)} PDFs")
+        return existing_index, INDEX_EMPTY
+    
+    index = update_index(existing_index, new_documents, removed_ids)
+    if index is existing_index:
+        return existing_index, INDEX_FAILED
+    return index, INDEX_UPDATED
+
 def save_index(index: FAISS, path: str = "faiss_index") -> bool:
     """
     Save index to disk
@@ -62,7 +424,11 @@ def save_index(index: FAISS, path: str = "faiss_index") -> bool:
         logger.warning("Cannot save None index")
         return False
     
+    device_index = index.index
     try:
+        # GPU indexes cannot be serialized directly
+        if is_gpu_index(device_index):
+            index.index = faiss.index_gpu_to_cpu(device_index)
         index.save_local(path)
         logger.info(f"Index saved to {path}")
         return True
@@ -70,14 +436,34 @@ def save_index(index: FAISS, path: str = "faiss_index") -> bool:
     except Exception as e:
         logger.error(f"Index save failed: {e}")
         return False
+    
+    finally:
+        index.index = device_index
 
 def load_index(path: str = "faiss_index") -> Optional[FAISS]:
     """
     Load index from disk
     """
     try:
-        embeddings = OpenAIEmbeddings()
-        index = FAISS.load_local(path, embeddings)
+        embeddings = get_embeddings()
+        # The docstore pickle is written by save_index, so it is trusted
+        index = FAISS.load_local(
+            path, 
+            embeddings, 
+            allow_dangerous_deserialization=True, 
+            **vectorstore_options()
+        )
+        if index.index.metric_type != faiss.METRIC_INNER_PRODUCT:
+            logger.warning(f"Index at {path} uses L2 distance, it must be rebuilt")
+            return None
+        if any(
+            'file_hash' not in index.docstore.search(doc_id).metadata
+            for doc_id in index.index_to_docstore_id.values()
+        ):
+            logger.warning(f"Index at {path} has no file hashes, it must be rebuilt")
+            return None
+        configure_search(index)
+        move_to_gpu(index)
         logger.info(f"Index loaded from {path}")
         return index
     
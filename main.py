@@ -1,10 +1,13 @@
 import os
 import sys
+import threading
+from itertools import chain
 import streamlit as st
-from typing import List
-from langchain.docstore.document import Document
-from extract_documents import extract_text_from_folder
-from index_manager import create_index, load_index, save_index
+from extract_documents import list_pdf_files
+from index_manager import (
+    INDEX_EMPTY, INDEX_FAILED, INDEX_SKIPPED, INDEX_UPDATED,
+    create_index_from_folder, index_new_files, load_index, save_index
+)
 from query_handler import answer_query_with_context
 
 # Configure page settings
@@ -26,28 +29,35 @@ def init_session_state():
         st.session_state.chat_history = []
     if 'documents_loaded' not in st.session_state:
         st.session_state.documents_loaded = False
-
-def load_documents() -> List[Document]:
-    """Load and process documents from the convocatorias folder"""
-    if not os.path.exists(FOLDER_PATH):
-        os.makedirs(FOLDER_PATH)
-    return extract_text_from_folder(FOLDER_PATH)
+    if 'processed_uploads' not in st.session_state:
+        st.session_state.processed_uploads = set()
 
 def initialize_index():
     """Initialize or load the FAISS index"""
+    if not os.path.exists(FOLDER_PATH):
+        os.makedirs(FOLDER_PATH)
+    
     if os.path.exists(INDEX_PATH):
         index = load_index(INDEX_PATH)
         if index:
+            # Index only PDFs added to the folder since the last save
+            index, status = index_new_files(index, list_pdf_files(FOLDER_PATH))
+            if status == INDEX_UPDATED:
+                save_index(index, INDEX_PATH)
             return index
     
-    documents = load_documents()
-    if documents:
-        index = create_index(documents)
-        if index:
-            save_index(index, INDEX_PATH)
-            return index
+    # Parse and embed the convocatorias folder in one pipeline
+    index = create_index_from_folder(FOLDER_PATH)
+    if index:
+        save_index(index, INDEX_PATH)
+        return index
     return None
 
+@st.cache_resource(show_spinner=False)
+def get_shared_index():
+    """Share one index across sessions; uploads swap in a new one under the lock"""
+    return {"index": initialize_index(), "lock": threading.Lock()}
+
 def main():
     # Initialize session state
     init_session_state()
@@ -59,13 +69,18 @@ def main():
     # Initialize or load index if not already done
     if not st.session_state.documents_loaded:
         with st.spinner("Cargando documentos..."):
-            st.session_state.index = initialize_index()
-            if st.session_state.index:
+            if get_shared_index()["index"]:
                 st.session_state.documents_loaded = True
                 st.success("Base de conocimiento cargada exitosamente!")
             else:
+                # No cachear el fallo para reintentar en la próxima ejecución
+                get_shared_index.clear()
                 st.warning("No se pudo cargar la base de conocimiento. Por favor, verifica los documentos.")
     
+    # Pick up an index swapped in by any session's upload
+    if st.session_state.documents_loaded:
+        st.session_state.index = get_shared_index()["index"]
+    
     # File uploader
     with st.expander("Subir nuevos documentos"):
         uploaded_files = st.file_uploader(
@@ -74,21 +89,55 @@ def main():
             type=["pdf"]
         )
         
-        if uploaded_files:
+        # Streamlit re-sends the same uploads on every rerun; file_id changes
+        # on each new upload, even of a file with the same name and size
+        new_uploads = [
+            f for f in uploaded_files or []
+            if f.file_id not in st.session_state.processed_uploads
+        ]
+        
+        if new_uploads:
             with st.spinner("Procesando nuevos documentos..."):
-                for uploaded_file in uploaded_files:
+                saved_paths = []
+                for uploaded_file in new_uploads:
                     # Save uploaded file
                     save_path = os.path.join(FOLDER_PATH, uploaded_file.name)
                     with open(save_path, "wb") as f:
                         f.write(uploaded_file.read())
+                    saved_paths.append(save_path)
                 
-                # Reload documents and recreate index
-                documents = load_documents()
-                if documents:
-                    st.session_state.index = create_index(documents)
-                    if st.session_state.index:
-                        save_index(st.session_state.index, INDEX_PATH)
-                        st.success("Documentos procesados exitosamente!")
+                # Embed only documents whose contents are not indexed yet
+                # (replacing older versions of overwritten files), into a new
+                # index that replaces the shared one. One file at a time so
+                # each upload gets its own outcome.
+                shared = get_shared_index()
+                statuses = {}
+                with shared["lock"]:
+                    index = shared["index"]
+                    for uploaded_file, save_path in zip(new_uploads, saved_paths):
+                        index, status = index_new_files(index, [save_path])
+                        statuses[uploaded_file.name] = status
+                        # Failed or empty uploads are retried on the next rerun
+                        if status in (INDEX_UPDATED, INDEX_SKIPPED):
+                            st.session_state.processed_uploads.add(uploaded_file.file_id)
+                    if index is not shared["index"]:
+                        save_index(index, INDEX_PATH)
+                        shared["index"] = index
+                
+                st.session_state.index = shared["index"]
+                if st.session_state.index:
+                    st.session_state.documents_loaded = True
+                
+                for name, status in statuses.items():
+                    if status == INDEX_EMPTY:
+                        st.warning(f"No se pudo extraer texto de {name}. ¿Es un PDF escaneado o dañado?")
+                    elif status == INDEX_FAILED:
+                        st.error(f"Error al indexar {name}. Inténtalo de nuevo más tarde.")
+                
+                if INDEX_UPDATED in statuses.values():
+                    st.success("Documentos procesados exitosamente!")
+                elif all(status == INDEX_SKIPPED for status in statuses.values()):
+                    st.info("Los documentos ya estaban en la base de conocimiento.")
     
     # Show available documents
     with st.expander("Ver documentos disponibles"):
@@ -124,14 +173,19 @@ def main():
         with st.chat_message("bake"):
             if st.session_state.index is None:
                 response = "Lo siento, no hay documentos cargados en la base de conocimiento. Por favor, verifica que los documentos estén disponibles."
+                st.write(response)
             else:
+                stream = answer_query_with_context(
+                    query,
+                    st.session_state.index,
+                    st.session_state.chat_history
+                )
+                # Show the spinner only until the first chunk arrives
                 with st.spinner("Pensando..."):
-                    response = answer_query_with_context(
-                        query,
-                        st.session_state.index,
-                        st.session_state.chat_history
-                    )
-            st.write(response)
+                    first_chunk = next(stream, "")
+                
+                # Render tokens as they arrive and keep the full text
+                response = st.write_stream(chain([first_chunk], stream))
         
         # Update chat history
         st.session_state.chat_history.extend([
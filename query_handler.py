@@ -1,49 +1,94 @@
 import os
 import logging
 import re
-from typing import List, Dict, Optional
+from functools import cache, lru_cache
+from typing import List, Dict, Iterator, Optional
+import numpy as np
 from openai import OpenAI
 from langchain_community.vectorstores import FAISS
 
+logger = logging.getLogger(__name__)
+
+# Patrones precompilados
+_PUNCT_RE = re.compile(r'[^\w\s]')
+
+# Modelos: uno ligero por defecto y, opcionalmente, otro mayor cuando la
+# recuperación es dudosa. El umbral no está calibrado: la escalada queda
+# desactivada por defecto hasta medir la distribución de puntuaciones.
+DEFAULT_MODEL = "gpt-4o-mini"
+ESCALATION_MODEL = "gpt-4o"
+LOW_CONFIDENCE_SCORE = 0.85
+
+# Umbrales de similitud coseno: más bajo para artículos que para contenido general
+ARTICLE_SCORE_THRESHOLD = 0.75
+GENERAL_SCORE_THRESHOLD = 0.80
+
+# Generic expansions for common terms
+_EXPANSIONS = {
+    'fecha': ('plazo', 'cuando'),
+    'plazo': ('fecha', 'periodo'),
+    'requisito': ('condicion', 'requerimiento'),
+    'documento': ('documentacion', 'papel'),
+    'ayuda': ('subvencion', 'financiacion')
+}
+
+@cache
+def get_client() -> OpenAI:
+    """
+    Shared OpenAI client so queries reuse its connection pool
+    """
+    return OpenAI()
+
+@lru_cache(maxsize=256)
 def preprocess_query(query: str) -> str:
     """
     Simple and generic query preprocessing
     """
     query = query.lower()
-    query = re.sub(r'[^\w\s]', '', query)
+    query = _PUNCT_RE.sub('', query)
     
-    # Generic expansions for common terms
-    expansions = {
-        'fecha': ['plazo', 'cuando'],
-        'plazo': ['fecha', 'periodo'],
-        'requisito': ['condicion', 'requerimiento'],
-        'documento': ['documentacion', 'papel'],
-        'ayuda': ['subvencion', 'financiacion']
-    }
-    
-    # Simple query expansion
-    expanded_terms = set([query])
+    # Simple query expansion, keeping the original word order
     words = query.split()
+    terms = list(dict.fromkeys(words))
     
     # Add expansions for individual words if they exist
     for word in words:
-        if word in expansions:
-            expanded_terms.update(expansions[word])
+        terms.extend(_EXPANSIONS.get(word, ()))
     
-    expanded_query = ' '.join(expanded_terms)
+    expanded_query = ' '.join(dict.fromkeys(terms))
     return expanded_query
 
+def rerank(
+    scores: np.ndarray, 
+    is_article: np.ndarray, 
+    article_threshold: float = ARTICLE_SCORE_THRESHOLD, 
+    general_threshold: float = GENERAL_SCORE_THRESHOLD
+) -> np.ndarray:
+    """
+    Return indices of results above their threshold, articles first and
+    then by descending score
+    """
+    thresholds = np.where(is_article, article_threshold, general_threshold)
+    keep = np.flatnonzero(scores > thresholds)
+    return keep[np.lexsort((-scores[keep], ~is_article[keep]))]
+
 def answer_query_with_context(
     query: str, 
     index: FAISS, 
-    chat_history: List[Dict[str, str]] = []
-) -> str:
+    chat_history: List[Dict[str, str]] = [],
+    model: str = DEFAULT_MODEL,
+    escalation_model: Optional[str] = None
+) -> Iterator[str]:
     """
-    Enhanced response generation with better article handling
+    Enhanced response generation with better article handling.
+    Yields the answer incrementally as the model streams it. If
+    escalation_model is given (e.g. ESCALATION_MODEL), it is used instead
+    when the best retrieval score is below LOW_CONFIDENCE_SCORE.
     """
     try:
         if not index:
-            return "La base de conocimiento no está disponible."
+            yield "La base de conocimiento no está disponible."
+            return
 
         processed_query = preprocess_query(query)
         
@@ -51,47 +96,34 @@ def answer_query_with_context(
         docs = index.similarity_search_with_relevance_scores(processed_query, k=20)
         
         if not docs:
-            return ("No encontré información relevante para tu pregunta. "
-                   "¿Podrías reformularla?")
+            yield ("No encontré información relevante para tu pregunta. "
+                  "¿Podrías reformularla?")
+            return
         
         # Separar documentos por tipo y relevancia
-        article_docs = []
-        general_docs = []
-        
-        for doc, score in docs:
-            if doc.metadata.get('content_type') == 'article':
-                article_docs.append((doc, score))
-            else:
-                general_docs.append((doc, score))
-        
-        # Ordenar por relevancia
-        relevant_docs = []
-        
-        # Primero añadir artículos relevantes
-        for doc, score in article_docs:
-            if score > 0.03:  # Umbral más bajo para artículos
-                relevant_docs.append(doc)
+        scores = np.fromiter(
+            (score for _, score in docs), dtype=np.float32, count=len(docs)
+        )
+        is_article = np.fromiter(
+            (doc.metadata.get('content_type') == 'article' for doc, _ in docs),
+            dtype=bool, count=len(docs)
+        )
         
-        # Luego añadir documentos generales relevantes
-        for doc, score in general_docs:
-            if score > 0.05:  # Umbral normal para contenido general
-                relevant_docs.append(doc)
+        order = rerank(scores, is_article)
+        relevant_docs = [docs[i][0] for i in order]
         
         if not relevant_docs:
-            return ("No encontré información suficientemente relevante. "
-                   "¿Podrías reformular tu pregunta?")
+            yield ("No encontré información suficientemente relevante. "
+                  "¿Podrías reformular tu pregunta?")
+            return
 
         # Procesar contexto
         context_parts = []
         for doc in relevant_docs[:10]:
             source = doc.metadata.get('source', 'Documento sin nombre')
-            page_match = re.search(r'\[Página (\d+)\]', doc.page_content)
-            page = page_match.group(1) if page_match else 'N/A'
-            
-            # Limpiar el contenido
-            content = doc.page_content
-            content = re.sub(r'\[Página \d+\]', '', content)
-            content = content.strip()
+            # La página se asigna al indexar
+            page = doc.metadata.get('page') or 'N/A'
+            content = doc.page_content.strip()
             
             context_parts.append(f"[Fuente: {source} - Página {page}]:\n{content}")
 
@@ -116,24 +148,31 @@ def answer_query_with_context(
            - Si hay ambigüedad, menciona todas las interpretaciones posibles
         """
 
-        client = OpenAI()
+        # Escalar a un modelo mayor si la mejor coincidencia es poco fiable
+        if escalation_model and scores.max() < LOW_CONFIDENCE_SCORE:
+            model = escalation_model
+
+        client = get_client()
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": f"Contexto:\n{docs_context}\n\nPregunta: {query}"}
         ]
 
-        response = client.chat.completions.create(
-            model="gpt-4",
+        stream = client.chat.completions.create(
+            model=model,
             messages=messages,
             temperature=0.2,
-            max_tokens=800
+            max_tokens=800,
+            stream=True
         )
 
-        return response.choices[0].message.content
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
 
     except Exception as e:
         logger.error(f"Error processing query: {e}")
-        return f"Lo siento, ocurrió un error al procesar tu consulta: {str(e)}"
+        yield f"Lo siento, ocurrió un error al procesar tu consulta: {str(e)}"
 
 def format_chat_history(
     chat_history: List[Dict[str, str]], 